@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 import json
+import os
+import random
 import sys
-from itertools import cycle
+from functools import lru_cache
+from itertools import count, cycle
 from pathlib import Path
 from time import sleep
 
@@ -10,6 +13,11 @@ from botocore.exceptions import ClientError
 from daggerml import Dml, Resource
 
 _here_ = Path(__file__).parent
+INITIAL_DELAY = 1.0  # seconds
+MAX_DELAY = 30.0  # seconds
+BACKOFF_RATE = 1.5
+NO_WAIT_ITERS = int(os.getenv("CFN_NO_WAIT_ITERATIONS", "5"))
+MAX_FAILURE_REASONS = 10
 spinner = cycle(["⠋", "⠙", "⠹", "⠸", "⠼", "⠴", "⠦", "⠧", "⠇", "⠏"])
 
 
@@ -18,6 +26,26 @@ def write(msg):
     sys.stdout.flush()
 
 
+@lru_cache(maxsize=None)
+def get_client():
+    return boto3.client("cloudformation")
+
+
+def failure_reasons(client, name):
+    # events come newest first, so the reasons for the failure are up front
+    reasons = []
+    pages = client.get_paginator("describe_stack_events").paginate(
+        StackName=name, PaginationConfig={"MaxItems": 100, "PageSize": 50}
+    )
+    for page in pages:
+        for event in page["StackEvents"]:
+            if "ResourceStatusReason" in event:
+                reasons.append(event["ResourceStatusReason"])
+                if len(reasons) >= MAX_FAILURE_REASONS:
+                    return reasons
+    return reasons
+
+
 def describe_stack(client, name):
     try:
         stack = client.describe_stacks(StackName=name)["Stacks"][0]
@@ -41,22 +69,24 @@ def describe_stack(client, name):
         "CREATE_FAILED",
         "DELETE_FAILED",
     ]:
-        events = client.describe_stack_events(StackName=name)["StackEvents"]
-        failure_events = [e for e in events if "ResourceStatusReason" in e]
-        failure_reasons = [e["ResourceStatusReason"] for e in failure_events]
-        return {"status": "failed", "error_reasons": failure_reasons}
-    return {"status": "creating"}
+        return {"status": "failed", "error_reasons": failure_reasons(client, name)}
+    return {"status": "creating", "stack_status": status}
+
+
+@lru_cache(maxsize=None)
+def template_body():
+    with open(_here_ / "entrypoint.py") as f:
+        script = f.read()
+    with open(_here_ / "cf.json") as f:
+        js = json.load(f)
+    js["Resources"]["Fn"]["Properties"]["Code"] = {"ZipFile": script}
+    return json.dumps(js)
 
 
 def deploy(name, update):
-    client = boto3.client("cloudformation")
+    client = get_client()
     response = describe_stack(client, name)
     if response is None or update:
-        with open(_here_ / "entrypoint.py") as f:
-            script = f.read()
-        with open(_here_ / "cf.json") as f:
-            js = json.load(f)
-        js["Resources"]["Fn"]["Properties"]["Code"] = {"ZipFile": script}
         fn = (
             client.update_stack
             if update and response is not None
@@ -65,7 +95,7 @@ def deploy(name, update):
         try:
             response = fn(
                 StackName=name,
-                TemplateBody=json.dumps(js),
+                TemplateBody=template_body(),
                 Capabilities=["CAPABILITY_IAM", "CAPABILITY_NAMED_IAM"],
             )
         except ClientError as e:
@@ -78,13 +108,21 @@ def deploy(name, update):
                 return response
             raise
         response = {"status": "creating"}
-    while response["status"] == "creating":
+    delay = INITIAL_DELAY
+    for i in count():
+        if response["status"] != "creating":
+            break
+        if i >= NO_WAIT_ITERS:
+            sleep(random.uniform(delay * 0.5, delay))
+            delay = min(delay * BACKOFF_RATE, MAX_DELAY)
+        prev = response.get("stack_status")
         try:
-            sleep(10)
             response = describe_stack(client, name)
         except ClientError as e:
             print(f"\n⚠️  Error checking stack status: {e}")
             return {"status": "error", "message": str(e)}
+        if response.get("stack_status") != prev:
+            delay = INITIAL_DELAY
     return response
 
 
@@ -1,19 +1,22 @@
+import io
 import json
 import logging
 import os
 from dataclasses import dataclass, field
+from functools import lru_cache
 from textwrap import dedent
 from time import time
-from uuid import uuid4
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-TIMEOUT = 5  # seconds
 MAX_ITERS = 10
+MAX_POLL_DELAY = 30  # seconds
+DESCRIBE_TTL = 3  # seconds
 S3_BUCKET = os.environ["JOB_BUCKET"]
 S3_PREFIX = os.environ.get("JOB_PREFIX")
 DFLT_PROP = {"vcpus": 1, "memory": 512}
@@ -21,30 +24,47 @@ DELETE_DYNAMO_ON_FAIL = os.getenv("DELETE_DYNAMO_ON_FAIL")
 PENDING_STATES = ["SUBMITTED", "PENDING", "RUNNABLE", "STARTING", "RUNNING"]
 SUCCESS_STATE = "SUCCEEDED"
 FAILED_STATE = "FAILED"
+SUBMITTING_STATE = "submitting"
+CLAIM_TIMEOUT = 60  # seconds, the lambda timeout in cf.json
+MULTIPART_THRESHOLD = 8 * 1024 * 1024  # bytes
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=MULTIPART_THRESHOLD, max_concurrency=4
+)
 
 
+SESSION = boto3.session.Session()
+CONFIG = Config(
+    connect_timeout=5,
+    retries={"max_attempts": 0},
+    max_pool_connections=10,
+    tcp_keepalive=True,
+)
+
+
+@lru_cache(maxsize=None)
 def get_client(name):
     logger.info("getting %r client", name)
-    config = Config(connect_timeout=5, retries={"max_attempts": 0})
-    return boto3.client(name, config=config)
+    return SESSION.client(name, config=CONFIG)
 
 
 def s3_get(key):
-    s3_client = get_client("s3")
     try:
-        s3_client.head_object(Bucket=S3_BUCKET, Key=key)
+        resp = get_client("s3").get_object(Bucket=S3_BUCKET, Key=key)
     except ClientError as e:
-        if e.response["Error"]["Code"] == "404":
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
             return
         raise
-    resp = get_client("s3").get_object(Bucket=S3_BUCKET, Key=key)
     return resp["Body"].read().decode()
 
 
 def s3_put(data, key):
     client = get_client("s3")
     logger.info("putting data to s3://%s/%s", S3_BUCKET, key)
-    client.put_object(Bucket=S3_BUCKET, Key=key, Body=data.encode())
+    body = data.encode()
+    if len(body) > MULTIPART_THRESHOLD:
+        client.upload_fileobj(io.BytesIO(body), S3_BUCKET, key, Config=TRANSFER_CONFIG)
+    else:
+        client.put_object(Bucket=S3_BUCKET, Key=key, Body=body)
     logger.info("returning")
     return f"s3://{S3_BUCKET}/{key}"
 
@@ -53,12 +73,20 @@ def now():
     return int(time())
 
 
+@lru_cache(maxsize=32)
+def prep_script(script):
+    return dedent(script).strip()
+
+
 @dataclass
 class Dynamo:
     cache_key: str
-    run_id: str = field(default_factory=lambda: uuid4().hex)
+    version: int = 0
     db: "boto3.client" = field(default_factory=lambda: get_client("dynamodb"))
     tb = os.environ["DYNAMODB_TABLE"]
+    _PUT_NAMES = {"#v": "version", "#ut": "update_time", "#obj": "obj"}
+    _GET_NAMES = {"#v": "version", "#obj": "obj"}
+    _DELETE_NAMES = {"#v": "version"}
 
     def _update(self, key=None, **kw):
         try:
@@ -70,84 +98,83 @@ class Dynamo:
             return True
         except ClientError as e:
             if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
-                logger.info("could not update %r (invalid lock)", self.cache_key)
+                logger.info("could not update %r (stale version)", self.cache_key)
                 return False
             raise
 
-    def put(self, obj):
+    def _bump(self, expr, names, values=None, ut=None):
+        # optimistic lock: only write if nobody else has since we last read
+        values = {
+            ":vn": {"N": str(self.version + 1)},
+            ":ut": {"N": str(now() if ut is None else ut)},
+            **(values or {}),
+        }
+        if self.version:
+            values[":v"] = {"N": str(self.version)}
+            cond = "#v = :v"
+        else:
+            cond = "attribute_not_exists(#v)"
+        ok = self._update(
+            UpdateExpression=expr,
+            ConditionExpression=cond,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+        )
+        if ok:
+            self.version += 1
+        return ok
+
+    def put(self, obj, ut=None):
         logger.info("putting data for %r", self.cache_key)
-        ut = now()
-        return self._update(
-            UpdateExpression="SET #lk = :lk, #ut = :ut, #obj = :obj",
-            ConditionExpression="attribute_not_exists(#lk) OR #lk = :lk OR #ut < :to",
-            ExpressionAttributeNames={
-                "#lk": "lock_key",
-                "#ut": "update_time",
-                "#obj": "obj",
-            },
-            ExpressionAttributeValues={
-                ":lk": {"S": self.run_id},
-                ":ut": {"N": str(ut)},
-                ":to": {"N": str(ut - TIMEOUT)},
-                ":obj": {"S": json.dumps(obj)},
-            },
+        return self._bump(
+            "SET #v = :vn, #ut = :ut, #obj = :obj",
+            self._PUT_NAMES,
+            {":obj": {"S": json.dumps(obj, separators=(",", ":"))}},
+            ut,
         )
 
     def get(self):
         logger.info("getting data for %r", self.cache_key)
         resp = self.db.get_item(
-            TableName=self.tb, Key={"cache_key": {"S": self.cache_key}}
+            TableName=self.tb,
+            Key={"cache_key": {"S": self.cache_key}},
+            ConsistentRead=True,
+            ProjectionExpression="#v, #obj",
+            ExpressionAttributeNames=self._GET_NAMES,
         )
-        if "obj" not in resp["Item"]:
+        item = resp.get("Item", {})
+        self.version = int(item.get("version", {"N": "0"})["N"])
+        if "obj" not in item:
             return
-        return json.loads(resp["Item"]["obj"]["S"])
+        return json.loads(item["obj"]["S"])
 
-    def lock(self, key=None):
-        logger.info("acquiring lock for %r", self.cache_key)
+    def claim(self):
+        logger.info("claiming %r for submit", self.cache_key)
         ut = now()
-        return self._update(
-            key,
-            UpdateExpression="SET #lk = :lk, #ut = :ut",
-            ConditionExpression="attribute_not_exists(#lk) OR #lk = :lk OR #ut < :to",
-            ExpressionAttributeNames={
-                "#lk": "lock_key",
-                "#ut": "update_time",
-            },
-            ExpressionAttributeValues={
-                ":lk": {"S": self.run_id},
-                ":ut": {"N": str(ut)},
-                ":to": {"N": str(ut - TIMEOUT)},
-            },
-        )
-
-    def unlock(self, key=None):
-        logger.info("releasing lock for %r", self.cache_key)
-        return self._update(
-            key,
-            UpdateExpression="REMOVE #lk SET #ut = :ut",
-            ConditionExpression="#lk = :lk",
-            ExpressionAttributeNames={"#lk": "lock_key", "#ut": "update_time"},
-            ExpressionAttributeValues={
-                ":lk": {"S": self.run_id},
-                ":ut": {"N": str(now())},
-            },
-        )
+        return self.put({"status": SUBMITTING_STATE, "claimed_at": ut}, ut)
 
     def delete(self):
-        ut = now()
-        return self.db.delete_item(
-            TableName=self.tb,
-            Key={"cache_key": {"S": self.cache_key}},
-            ConditionExpression="attribute_not_exists(#lk) OR #lk = :lk OR #ut < :to",
-            ExpressionAttributeNames={
-                "#lk": "lock_key",
-                "#ut": "update_time",
-            },
-            ExpressionAttributeValues={
-                ":lk": {"S": self.run_id},
-                ":to": {"N": str(ut - TIMEOUT)},
-            },
-        )
+        if self.version:
+            kw = {
+                "ConditionExpression": "#v = :v",
+                "ExpressionAttributeValues": {":v": {"N": str(self.version)}},
+            }
+        else:
+            # records written before versioning have no version attribute
+            kw = {"ConditionExpression": "attribute_not_exists(#v)"}
+        try:
+            self.db.delete_item(
+                TableName=self.tb,
+                Key={"cache_key": {"S": self.cache_key}},
+                ExpressionAttributeNames=self._DELETE_NAMES,
+                **kw,
+            )
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                logger.info("could not delete %r (stale version)", self.cache_key)
+                return False
+            raise
 
 
 @dataclass
@@ -157,6 +184,7 @@ class Batch:
     job_def: str | None = None
     status: str | None = None
     iters: int = 0
+    described_at: int = 0
     client: "boto3.client" = field(default_factory=lambda: get_client("batch"))
 
     @property
@@ -169,6 +197,20 @@ class Batch:
     def result_key(self):
         return f"{self.prefix}/result.dump"
 
+    @property
+    def recently_described(self):
+        return (
+            self.status in PENDING_STATES and now() - self.described_at < DESCRIBE_TTL
+        )
+
+    @property
+    def status_message(self):
+        return f"Job {self.job_id} is processing with status: {self.status}"
+
+    @property
+    def next_delay(self):
+        return min(MAX_POLL_DELAY, 2**self.iters)
+
     def _create_job_def(self, **kw):
         response = self.client.register_job_definition(**kw)
         logger.info(
@@ -195,7 +237,7 @@ class Batch:
                 "command": [
                     "python3",
                     "-c",
-                    dedent(script).strip(),
+                    prep_script(script),
                 ],
                 "environment": [
                     {"name": "DML_INPUT", "value": dump_ps},
@@ -221,6 +263,7 @@ class Batch:
         response = self.client.describe_jobs(jobs=[self.job_id])
         job = response["jobs"][0]
         self.status = job["status"]
+        self.described_at = now()
         if self.status == SUCCESS_STATE:
             return f"Job {self.job_id} succeeded."
         if self.status == FAILED_STATE:
@@ -242,7 +285,7 @@ class Batch:
                 separators=(",", ":"),
             )
             return msg
-        return f"Job {self.job_id} is processing with status: {self.status}"
+        return self.status_message
 
     def gc(self):
         try:
@@ -260,10 +303,12 @@ class Batch:
             "job_id": self.job_id,
             "job_def": self.job_def,
             "status": self.status,
+            "iters": self.iters,
+            "described_at": self.described_at,
         }
 
 
-def success_pipeline(dynamo, batch):
+def success_pipeline(dynamo, batch, changed=False):
     if batch.iters == 0:
         batch.gc()
     dump = s3_get(batch.result_key)
@@ -275,12 +320,17 @@ def success_pipeline(dynamo, batch):
                 "dump": None,
             }
         batch.iters += 1
-        dynamo.put(batch.state_dict())
+        if not dynamo.put(batch.state_dict()):
+            return busy()
         return {
             "status": 204,
             "message": "waiting for task to write output",
             "dump": None,
+            "next_delay": batch.next_delay,
         }
+    if changed:
+        # the output is there either way, so a lost write doesn't matter here
+        dynamo.put(batch.state_dict())
     return {
         "status": 200,
         "message": "Job finished",
@@ -288,24 +338,44 @@ def success_pipeline(dynamo, batch):
     }
 
 
+def busy():
+    return {
+        "status": 204,
+        "message": "Job record is busy or was updated concurrently",
+        "dump": None,
+    }
+
+
 def handler(event, context):
     dynamo = Dynamo(event["cache_key"])
-    if not dynamo.lock():
-        return {"status": 204, "message": "Could not acquire job lock"}
     try:
         logger.info("getting dynamo info")
         info = dynamo.get() or {}
+        if info.get("status") == SUBMITTING_STATE:
+            if now() - info["claimed_at"] < CLAIM_TIMEOUT:
+                return busy()
+            logger.info("taking over stale submit claim for %r", dynamo.cache_key)
+            info = {}
         logger.info("initializing batch client")
         batch = Batch(event["cache_key"], **info)
         if batch.status is None:
+            # mark the submit in progress; callers that see it back off
+            if not dynamo.claim():
+                return busy()
             logger.info("submitting job now")
-            kw = {k: v[-1] for k, v in event["kwargs"].items()}
-            if "requirements" not in kw:
-                kw["requirements"] = {}
-            logger.info("submitting job with kwargs: %s", json.dumps(kw))
-            batch.submit(dump=event["dump"], **kw)
+            try:
+                kw = {k: v[-1] for k, v in event["kwargs"].items()}
+                if "requirements" not in kw:
+                    kw["requirements"] = {}
+                logger.info("submitting job with kwargs: %s", kw)
+                batch.submit(dump=event["dump"], **kw)
+            except Exception:
+                # drop our claim so the next call can retry right away
+                dynamo.delete()
+                raise
             logger.info("putting batch state")
-            dynamo.put(batch.state_dict())
+            if not dynamo.put(batch.state_dict()):
+                return busy()
             logger.info("returning")
             return {
                 "status": 201,
@@ -314,17 +384,25 @@ def handler(event, context):
             }
         if batch.status == SUCCESS_STATE:
             return success_pipeline(dynamo, batch)
+        if batch.recently_described:
+            return {"status": 202, "message": batch.status_message, "dump": None}
         msg = batch.update()
-        dynamo.put(batch.state_dict())
+        if batch.status == FAILED_STATE and DELETE_DYNAMO_ON_FAIL:
+            dynamo.delete()
+            return {"status": 400, "message": msg, "dump": None}
+        if batch.status == SUCCESS_STATE:
+            # success_pipeline makes the one write of the new state
+            return success_pipeline(dynamo, batch, changed=True)
+        if not dynamo.put(batch.state_dict()):
+            return busy()
         if batch.status in PENDING_STATES:
-            dynamo.put(batch.state_dict())
             return {"status": 202, "message": msg, "dump": None}
         if batch.status == FAILED_STATE:
-            if DELETE_DYNAMO_ON_FAIL:
-                dynamo.delete()
             return {"status": 400, "message": msg, "dump": None}
-        return success_pipeline(dynamo, batch)
+        return {
+            "status": 400,
+            "message": f"Job {batch.job_id} has unexpected status: {batch.status}",
+            "dump": None,
+        }
     except Exception as e:
         return {"status": 400, "message": str(e), "dump": None}
-    finally:
-        dynamo.unlock()